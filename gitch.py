@@ -2,18 +2,37 @@
 
 from __future__ import print_function
 import argparse
+import configparser
+import hashlib
+import json
 import logging
 import os
 import re
 import sys
 import subprocess
-
-import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 logger = logging.getLogger("gitch")
 debugging = (os.getenv("GITCH_DEBUG", "").lower() in ("1", "t", "true"))
 
+# Matches ssh ('git@github.com:user/repo.git') and https
+# ('https://github.com/user/repo[.git]') remote URLs.
+#
+_REMOTE_RE = re.compile(
+    r'^(?:git@|https?://)([^:/]+)[:/]([^/]+)/([^/]+?)(?:\.git)?$'
+)
+
+# Matches one changelog section - an H2 header line ('## <tag> [<rest>]'),
+# then everything up to the next H2 or end of file.
+#
+_SECTION_RE = re.compile(
+    r'(?ms)^##[ \t]+(\S+)([^\n]*)\n?(.*?)(?=^##[ \t]|\Z)'
+)
+
+# matches just the H2 header line of a changelog section
+_SECTION_HEADER_RE = re.compile(r'^##[ \t]+(\S+)([^\n]*)')
+
 
 class GitchError(Exception):
     pass
@@ -56,61 +75,70 @@ class ChangelogSyncer(object):
         self.changelog_filepath = None
         self.github_user = None
         self.github_repo_name = None
+        self.github_url = None
         self.changelog_sections = None
         self.gh_releases = None
+        self.remote_tags = None
         self.branch = None
 
-        # find root dir of local git repo checkout
+        self._sections_by_tag = None
+        self._releases_by_tag = None
+        self._bootstrapped = False
+
+        # Find root dir of local git repo checkout, and the checked out
+        # branch, in a single git invocation.
+        #
         try:
-            out = self._git("rev-parse", "--show-toplevel")
-            root_path = out.strip()
+            out = self._git(
+                "rev-parse", "--show-toplevel", "--abbrev-ref", "HEAD")
         except subprocess.CalledProcessError:
-            raise GitchError("Not in a git repository")
+            # HEAD may be unresolvable (eg new repo with no commits)
+            try:
+                out = self._git("rev-parse", "--show-toplevel")
+            except subprocess.CalledProcessError:
+                raise GitchError("Not in a git repository")
+
+        lines = out.strip().split('\n')
+        root_path = lines[0]
+
+        if len(lines) > 1 and lines[1] != "HEAD":  # detached HEAD mode
+            self.branch = lines[1]
 
         # check that there is a remote
-        try:
-            out = self._git("remote", "get-url", "origin")
-            remote_url = out.strip()
-        except subprocess.CalledProcessError:
+        remote_url = self._get_remote_url(root_path)
+        if not remote_url:
             raise GitchError("There is no git remote")
 
         # find changelog
         self.changelog_filepath = os.path.join(root_path, "CHANGELOG.md")
         if not os.path.isfile(self.changelog_filepath):
-            raise GitchError("Expected changelog at %s", self.changelog_filepath)
-
-        # get checked out branch
-        try:
-            out = self._git("rev-parse", "--abbrev-ref", "HEAD")
-            branch = out.strip()
-            if branch != "HEAD":  # detached HEAD mode
-                self.branch = branch
-        except:
-            pass
+            raise GitchError(
+                "Expected changelog at %s" % self.changelog_filepath
+            )
 
-        # Check remote is a github repo, and parse out user and repo name.
-        # Expecting remote_url like 'git@github.com:nerdvegas/gitch.git'
-        #
-        regex = re.compile("^git@(.*):(.*)/(.*)\\.git$")
-        m = regex.match(remote_url)
+        # check remote is a github repo, and parse out user and repo name
+        m = _REMOTE_RE.match(remote_url)
         if not m or m.groups()[0] != "github.com":
             raise GitchError("Not a github repository")
 
         self.github_user = m.groups()[1]
         self.github_repo_name = m.groups()[2]
 
-    @property
-    def github_url(self):
-        return (
+        # computed once - _send_github_request uses it on every call
+        self.github_url = (
             "https://api.github.com/repos/%s/%s"
             % (self.github_user, self.github_repo_name)
         )
 
+        self._session = None
+
     def get_changelog_tags(self):
         """Get tags in changelog, in order they appear.
         """
-        sections = self._get_changelog_sections()
-        return [x["tag"] for x in sections]
+        if self.changelog_sections is not None:
+            return [x["tag"] for x in self.changelog_sections]
+
+        return list(self._iter_changelog_tags())
 
     def sync(self, tag):
         """Sync a changelog section to github release notes.
@@ -118,14 +146,8 @@ class ChangelogSyncer(object):
         Args:
             tag (str): changelog section to sync.
         """
-        section = None
-
         # get changelog section for this tag
-        sections = self._get_changelog_sections()
-        for sec in sections:
-            if sec["tag"] == tag:
-                section = sec
-                break
+        section = self._get_changelog_section(tag)
 
         if not section:
             raise SectionNotExistsError(
@@ -138,17 +160,13 @@ class ChangelogSyncer(object):
         # too easy to bugger things up by creating a tag unintentionally (due to
         # a typo in your changelog), and we don't want that.
         #
-        out = self._git("ls-remote", "origin", "refs/tags/" + tag)
-        if not out.strip():
+        if tag not in self._get_remote_tags():
             raise TagNotExistsError(
                 "Tag %r does not exist at the remote" % tag
             )
 
         # determine if release already exists
-        existing_release = None
-        for release in self._get_gh_releases():
-            if release["tag_name"] == tag:
-                existing_release = release
+        existing_release = self._get_releases_by_tag().get(tag)
 
         # avoid overwrite if gh release already exists
         if not self.overwrite and existing_release:
@@ -168,8 +186,24 @@ class ChangelogSyncer(object):
         }
 
         if existing_release:
+            # PATCH only the fields that differ - github re-renders the
+            # release for every field written. No diff, no request. Fields
+            # the fetched release doesn't carry are left out rather than
+            # treated as changed - the graphql bootstrap has no
+            # target_commitish, and github ignores it on an existing tag
+            # anyway.
+            #
+            diff = {
+                k: v for k, v in data.items()
+                if k in existing_release and existing_release[k] != v
+            }
+
+            if not diff:
+                logger.info("%r is unchanged, skipping", tag)
+                return existing_release["html_url"]
+
             endpoint = "releases/" + str(existing_release["id"])
-            resp = self._send_github_request("PATCH", endpoint, json=data)
+            resp = self._send_github_request("PATCH", endpoint, json=diff)
         else:
             resp = self._send_github_request("POST", "releases", json=data)
 
@@ -177,11 +211,71 @@ class ChangelogSyncer(object):
         return resp.json()["html_url"]
 
     def _git(self, *nargs):
-        return subprocess.check_output(
+        proc = subprocess.run(
             ["git"] + list(nargs),
-            stderr=subprocess.PIPE,
-            cwd=self.path
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=self.path,
+            check=True,
+            text=True
         )
+        return proc.stdout
+
+    def _get_remote_url(self, root_path):
+        """Get the URL of the origin remote, or None if there isn't one.
+
+        Reads .git/config directly where possible, saving a git process
+        spawn at startup.
+        """
+        config_filepath = os.path.join(root_path, ".git", "config")
+
+        try:
+            config = configparser.ConfigParser()
+            config.read(config_filepath)
+            return config.get('remote "origin"', "url")
+        except (IOError, OSError, configparser.Error):
+            pass
+
+        # Fall back to git itself - .git may be a pointer file (worktrees,
+        # submodules), or the config may be unparseable.
+        #
+        try:
+            return self._git("config", "--get", "remote.origin.url").strip()
+        except subprocess.CalledProcessError:
+            return None
+
+    def _get_remote_tags(self):
+        """Get the set of tags that exist at the remote.
+
+        Listing the tags once and caching them means an --all sync hits the
+        remote once, rather than once per tag.
+        """
+        if self.remote_tags is not None:
+            return self.remote_tags
+
+        self._bootstrap()
+        if self.remote_tags is not None:
+            return self.remote_tags
+
+        out = self._git("ls-remote", "--tags", "origin")
+        tags = set()
+
+        for line in out.strip().split('\n'):
+            # lines are like '<sha>\trefs/tags/<tag>'
+            parts = line.split("refs/tags/")
+            if len(parts) < 2:
+                continue
+
+            tag = parts[1]
+
+            # ignore peeled refs ('<tag>^{}')
+            if tag.endswith("^{}"):
+                continue
+
+            tags.add(tag)
+
+        self.remote_tags = tags
+        return self.remote_tags
 
     def _get_changelog_sections(self):
         """
@@ -192,56 +286,348 @@ class ChangelogSyncer(object):
         if self.changelog_sections is not None:
             return self.changelog_sections
 
+        # The changelog only changes on release, so cache the parsed sections
+        # to disk, keyed on the file's mtime and size.
+        #
+        st = os.stat(self.changelog_filepath)
+        stat_key = [st.st_mtime_ns, st.st_size]
+
+        cache_filepath = self._changelog_cache_path()
+        cached = self._load_cache(cache_filepath)
+
+        if cached and cached.get("key") == stat_key:
+            self.changelog_sections = cached["data"]
+            return self.changelog_sections
+
+        # The stat key can miss even though the content is unchanged (eg a
+        # touch, or a branch switch swapping in an identical file) - check the
+        # git blob hash before giving up on the cache. On a match, refresh the
+        # stat key so the next run takes the cheap path again.
+        #
+        blob_sha = self._changelog_blob_sha()
+
+        if cached and blob_sha and cached.get("sha") == blob_sha:
+            self.changelog_sections = cached["data"]
+            self._save_cache(
+                cache_filepath,
+                {"key": stat_key, "sha": blob_sha,
+                 "data": self.changelog_sections}
+            )
+            return self.changelog_sections
+
+        # A single pass of the compiled regex over the whole buffer keeps the
+        # parse loop in C, rather than iterating lines in python.
+        #
         with open(self.changelog_filepath) as f:
-            lines = f.read().split('\n')
+            text = f.read()
+
+        self.changelog_sections = [
+            {
+                "tag": m.group(1),
+                "header": ' '.join((m.group(1) + m.group(2)).split()),
+                "content": m.group(3).rstrip()
+            }
+            for m in _SECTION_RE.finditer(text)
+        ]
+
+        self._save_cache(
+            cache_filepath,
+            {"key": stat_key, "sha": blob_sha, "data": self.changelog_sections}
+        )
+
+        return self.changelog_sections
+
+    def _changelog_blob_sha(self):
+        """Get the git blob hash of the changelog's current content.
+
+        Content-keyed, so stable across no-op edits and branch switches that
+        leave the file identical. Hashes the working tree file (rather than
+        HEAD's blob) so uncommitted edits are seen.
+        """
+        try:
+            return self._git(
+                "hash-object", "--", self.changelog_filepath
+            ).strip()
+        except subprocess.CalledProcessError:
+            return None
 
-        sections = []
-        curr_tag = None
-        curr_header = None
-        curr_lines = []
+    def _changelog_cache_path(self):
+        # The filepath is hashed into the name so that multiple checkouts of
+        # the same repo don't share a cache entry.
+        #
+        h = hashlib.sha1(self.changelog_filepath.encode("utf-8")).hexdigest()
+        return self._cache_path("changelog_%s.json" % h[:12])
 
-        def consume_section():
-            if curr_tag:
-                sections.append({
-                    "tag": curr_tag,
-                    "header": curr_header,
-                    "content": '\n'.join(curr_lines).rstrip()
-                })
+    def _iter_changelog_tags(self):
+        """Iterate over tags in the changelog, in the order they appear.
 
-        for line in lines:
-            parts = line.split()
+        Unlike the full parse, this never buffers section bodies.
+        """
+        with open(self.changelog_filepath) as f:
+            for line in f:
+                m = _SECTION_HEADER_RE.match(line)
+                if m:
+                    yield m.group(1)
 
-            if len(parts) > 1 and parts[0] == "##":  # H2
-                consume_section()
-                curr_tag = parts[1]
-                curr_header = ' '.join(parts[1:])
-                curr_lines = []
+    def _get_changelog_section(self, tag):
+        """Get a single changelog section, or None if there isn't one.
 
-            elif curr_tag:
-                curr_lines.append(line)
+        Uses the cached full parse if available; otherwise streams the file
+        and stops as soon as the requested section has been read.
+        """
+        if self.changelog_sections is not None:
+            return self._get_sections_by_tag().get(tag)
 
-        consume_section()
+        header = None
+        curr_lines = None
 
-        self.changelog_sections = sections
-        return self.changelog_sections
+        with open(self.changelog_filepath) as f:
+            for line in f:
+                m = _SECTION_HEADER_RE.match(line)
+
+                if m:
+                    if curr_lines is not None:
+                        break  # next section - ours is complete
+
+                    if m.group(1) == tag:
+                        header = ' '.join((m.group(1) + m.group(2)).split())
+                        curr_lines = []
+
+                elif curr_lines is not None:
+                    curr_lines.append(line.rstrip('\n'))
+
+        if curr_lines is None:
+            return None
+
+        return {
+            "tag": tag,
+            "header": header,
+            "content": '\n'.join(curr_lines).rstrip()
+        }
+
+    def _get_sections_by_tag(self):
+        """Get changelog sections indexed by tag, for O(1) lookup.
+        """
+        if self._sections_by_tag is None:
+            self._sections_by_tag = {
+                x["tag"]: x for x in self._get_changelog_sections()
+            }
+        return self._sections_by_tag
+
+    def _get_releases_by_tag(self):
+        """Get github releases indexed by tag, for O(1) lookup.
+        """
+        if self._releases_by_tag is None:
+            self._releases_by_tag = {
+                x["tag_name"]: x for x in self._get_gh_releases()
+            }
+        return self._releases_by_tag
 
     def _get_gh_releases(self):
         if self.gh_releases is not None:
             return self.gh_releases
 
-        resp = self._send_github_request("GET", "releases")
-        resp.raise_for_status()
-        self.gh_releases = resp.json()
+        self._bootstrap()
+        if self.gh_releases is not None:
+            return self.gh_releases
+
+        cache_filepath = self._cache_path("releases.json")
+        cached = self._load_cache(cache_filepath)
+
+        releases = []
+        etag = None
+        page = 1
+
+        while True:
+            headers = {}
+            if page == 1 and cached and cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+
+            resp = self._send_github_request(
+                "GET", "releases",
+                params={"per_page": 100, "page": page},
+                headers=headers
+            )
+
+            # Nothing changed since the cached copy was taken. Note that 304s
+            # do not count against the github rate limit.
+            #
+            if resp.status_code == 304:
+                self.gh_releases = cached["data"]
+                return self.gh_releases
+
+            resp.raise_for_status()
+
+            if page == 1:
+                etag = resp.headers.get("ETag")
+
+            page_data = resp.json()
+            releases.extend(page_data)
+
+            # a short page means we've hit the last one
+            if len(page_data) < 100:
+                break
+
+            page += 1
+
+        self._save_cache(cache_filepath, {"etag": etag, "data": releases})
+
+        self.gh_releases = releases
         return self.gh_releases
 
-    def _send_github_request(self, method, endpoint, **kwargs):
-        url = self.github_url + '/' + endpoint
-        headers = {
+    def _cache_path(self, name):
+        """Get the filepath of a gitch cache file for this repo.
+
+        Honours $XDG_CACHE_HOME, falling back to ~/.cache.
+        """
+        cache_root = os.getenv("XDG_CACHE_HOME") or \
+            os.path.join(os.path.expanduser("~"), ".cache")
+
+        filename = "%s_%s_%s" % (self.github_user, self.github_repo_name, name)
+        return os.path.join(cache_root, "gitch", filename)
+
+    @classmethod
+    def _load_cache(cls, filepath):
+        try:
+            with open(filepath) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    @classmethod
+    def _save_cache(cls, filepath, data):
+        # A failure to cache shouldn't stop a sync, so we just log and move on.
+        # Write-then-rename so a concurrent gitch never sees a partial file.
+        #
+        try:
+            dirname = os.path.dirname(filepath)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+            tmp_filepath = filepath + ".tmp"
+            with open(tmp_filepath, 'w') as f:
+                json.dump(data, f)
+
+            os.replace(tmp_filepath, filepath)
+        except (IOError, OSError) as e:
+            logger.debug("Could not write cache %s: %s", filepath, e)
+
+    def _bootstrap(self):
+        """Fetch github releases and remote tags in one graphql round-trip.
+
+        A graphql query costs one rate-limit point however much it resolves,
+        where the REST equivalent pays per page (and the tag check pays a git
+        spawn). Failure here is non-fatal; callers fall back to the
+        REST/ls-remote paths.
+        """
+        if self._bootstrapped:
+            return
+        self._bootstrapped = True
+
+        query = (
+            "query ($owner: String!, $name: String!) {"
+            "  repository(owner: $owner, name: $name) {"
+            "    releases(first: 100) {"
+            "      pageInfo { hasNextPage }"
+            "      nodes { tagName name description databaseId url }"
+            "    }"
+            "    refs(refPrefix: \"refs/tags/\", first: 100) {"
+            "      pageInfo { hasNextPage }"
+            "      nodes { name }"
+            "    }"
+            "  }"
+            "}"
+        )
+
+        try:
+            data = self._gh_graphql(query, {
+                "owner": self.github_user,
+                "name": self.github_repo_name
+            })
+        except Exception as e:
+            # eg graphql disabled by org SSO - the REST paths still work
+            logger.debug("github graphql bootstrap failed: %s", e)
+            return
+
+        releases = data["repository"]["releases"]
+        refs = data["repository"]["refs"]
+
+        # More than 100 of either is rare - leave those cases to the
+        # paginated REST/ls-remote paths.
+        #
+        if not releases["pageInfo"]["hasNextPage"]:
+            self.gh_releases = [
+                {
+                    "tag_name": x["tagName"],
+                    "name": x["name"],
+                    "body": x["description"],
+                    "id": x["databaseId"],
+                    "html_url": x["url"]
+                }
+                for x in releases["nodes"]
+            ]
+
+        if not refs["pageInfo"]["hasNextPage"]:
+            self.remote_tags = set(x["name"] for x in refs["nodes"])
+
+    def _gh_graphql(self, query, variables):
+        resp = self._get_session().post(
+            "https://api.github.com/graphql",
+            json={"query": query, "variables": variables}
+        )
+        resp.raise_for_status()
+
+        result = resp.json()
+        if result.get("errors"):
+            raise GitchError("github graphql error: %s" % result["errors"])
+
+        return result["data"]
+
+    def _get_session(self):
+        """Get the shared github session, creating it on first use.
+
+        One session for all github requests - reuses the TLS connection, and
+        transparently retries/backs off on transient server errors. The
+        requests import is deferred to here, since it's a comparatively heavy
+        import and modes like --list never make a request.
+        """
+        if self._session is not None:
+            return self._session
+
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        session = requests.Session()
+        session.headers.update({
             "Content-Type": "application/json",
+            "Accept": "application/vnd.github+json",
             "Authorization": "token " + self.token
-        }
+        })
+        session.mount("https://", HTTPAdapter(
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=(502, 503, 504)
+            )
+        ))
+
+        self._session = session
+        return self._session
+
+    def _send_github_request(self, method, endpoint, headers=None, **kwargs):
+        url = self.github_url + '/' + endpoint
+        session = self._get_session()
+
+        # Per-call headers (eg If-None-Match) are merged over the session's
+        # base headers explicitly, so callers can never collide with them.
+        #
+        if headers:
+            merged = dict(session.headers)
+            merged.update(headers)
+            headers = merged
 
-        return requests.request(method, url, headers=headers, **kwargs)
+        return session.request(method, url, headers=headers, **kwargs)
 
 
 def parse_args():
@@ -327,17 +713,49 @@ def sync_to_github(opts, syncer):
     if not tags_to_sync:
         error("No changelog entries")
 
-    num_synced = 0
+    # Without overwrite, syncing an already-released tag would just raise
+    # ReleaseExistsError after a wasted round-trip - skip those up-front.
+    #
+    if not opts.overwrite:
+        existing_tags = set(syncer._get_releases_by_tag())
 
-    for tag in tags_to_sync:
-        logger.info("Syncing %r to github...", tag)
+        for tag in tags_to_sync:
+            if tag in existing_tags:
+                logger.info("%r already released, skipping", tag)
 
-        try:
-            url = syncer.sync(tag)
-            logger.info("%r synced, see %s", tag, url)
-            num_synced += 1
-        except GitchError as e:
-            logger.warning(str(e))
+        tags_to_sync = [x for x in tags_to_sync if x not in existing_tags]
+
+    # Warm the syncer's lazy caches up-front, so that worker threads don't
+    # race the initialization below. A single-tag sync skips the full parse -
+    # sync() streams out just the section it needs.
+    #
+    if len(tags_to_sync) > 1:
+        syncer._get_sections_by_tag()
+
+    syncer._get_releases_by_tag()
+    syncer._get_remote_tags()
+
+    num_synced = 0
+
+    # Releases are independent of each other, so sync them concurrently -
+    # this is network-bound work.
+    #
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = {}
+
+        for tag in tags_to_sync:
+            logger.info("Syncing %r to github...", tag)
+            futures[executor.submit(syncer.sync, tag)] = tag
+
+        for future in as_completed(futures):
+            tag = futures[future]
+
+            try:
+                url = future.result()
+                logger.info("%r synced, see %s", tag, url)
+                num_synced += 1
+            except GitchError as e:
+                logger.warning(str(e))
 
     print("\n%d changelog entries pushed to github" % num_synced)
 